@@ -1,6 +1,7 @@
 import tkinter as tk
 from tkinter import filedialog, messagebox
 from collections import deque
+from dataclasses import dataclass, replace
 import threading
 import os
 import cv2
@@ -27,6 +28,31 @@ default_foldername = None
 sync_line_id = 2
 trigger_line_id = 0
 
+# Online analysis: frames are block-averaged by this factor before computing metrics,
+# and the (downsampled) frame is split into a grid of (rows, cols) sub-regions
+analysis_downsample = 4
+analysis_grid = (2, 2)
+# Frames waiting for analysis; when it falls behind the oldest are dropped (row skipped)
+analysis_queue_size = 32
+
+@dataclass(frozen=True)
+class AcquisitionSettings:
+    """Immutable snapshot of the GUI controls, read by the acquisition/writer threads.
+
+    The Tk side publishes a new snapshot (version + 1) whenever a control changes,
+    so worker threads never call Tk variables' .get() outside the main loop.
+    """
+    version: int
+    compression: str
+    preview_enabled: bool
+    mode: str
+    rotation: int
+    fps: float
+    save_path: str
+    analysis_enabled: bool
+    roi: tuple = None  # (x, y, w, h), None = full frame
+
+
 class FLIRApp:
     def __init__(self, root):
         self.root = root
@@ -65,6 +91,9 @@ class FLIRApp:
 
         self.frame_queue = deque()  # frames go from acquisition to writer
         self.queue_lock = threading.Lock()  # optional, for safety
+        self.analysis_queue = deque(maxlen=analysis_queue_size)  # (frame_index, timestamp, frame) from acquisition to analysis
+        self.analysis_lock = threading.Lock()
+        self.current_thread_analysis = None
         self.current_thread_writer = None
         self.next_thread_writer = None
         self.next_thread_writer_filename = None
@@ -80,8 +109,6 @@ class FLIRApp:
         # State Variables
         self.acquiring = False
         self.recording = False
-        self.roi_defined = False
-        self.roi = None  # (x, y, w, h)
         self.rotation = tk.IntVar(value=270)  # 0, 90, 180, 270
         self.save_path = tk.StringVar(value=default_path)
         self.foldername = tk.StringVar(value=default_foldername)
@@ -90,14 +117,30 @@ class FLIRApp:
         self.fps = tk.DoubleVar(value=30.0)
         self.brightness = tk.DoubleVar(value=1.0)
         self.compression = tk.StringVar(value="RAW")
-        self.last_compression = self.compression.get()
         self.exposure_time = tk.DoubleVar(value=15.0)  # microseconds (example default 5 ms)
         self.trial_index = 0
-        self.ttl_log = []  # store timestamps for current trial
+        self.ttl_log = []  # (host time, frame index, camera time) of each TTL for current trial
         self.frames_times_log = []  # store timestamps for current trial
         self.start_rec_time_hardware =None
         self.preview_enabled = tk.BooleanVar(value=True)
         self.last_preview_enabled = tk.BooleanVar(value=True)
+        self.analysis_enabled = tk.BooleanVar(value=False)
+
+        # Settings snapshot shared with the worker threads, replaced as a whole on change
+        self.settings_lock = threading.Lock()
+        self.settings = AcquisitionSettings(
+            version=0,
+            compression=self.compression.get(),
+            preview_enabled=self.preview_enabled.get(),
+            mode=self.mode.get(),
+            rotation=self.rotation.get(),
+            fps=self.fps.get(),
+            save_path=self.save_path.get(),
+            analysis_enabled=self.analysis_enabled.get(),
+        )
+        for name in ("compression", "preview_enabled", "mode", "rotation", "fps", "save_path", "analysis_enabled"):
+            var = getattr(self, name)
+            var.trace_add("write", lambda *args, name=name, var=var: self.on_setting_changed(name, var))
         # GUI Layout
         tk.Button(root, text="Select Save path", command=self.select_folder).pack()
         tk.Label(root, textvariable=self.save_path).pack()
@@ -116,7 +159,8 @@ class FLIRApp:
         tk.Entry(root, textvariable=self.fps).pack()
 
         tk.Label(root, text="Rotate image:").pack()
-        tk.OptionMenu(root, self.rotation, 0, 90, 180, 270).pack()
+        self.rotation_menu = tk.OptionMenu(root, self.rotation, 0, 90, 180, 270)
+        self.rotation_menu.pack()
 
         tk.Label(root, text="Brightness:").pack()
         tk.Entry(root, textvariable=self.brightness).pack()
@@ -131,9 +175,31 @@ class FLIRApp:
         tk.Button(root, text="Stop Recording", command=self.stop_recording).pack(side="left", padx=5)
 
         tk.Checkbutton(root, text="Enable Preview", variable=self.preview_enabled).pack()
+        tk.Checkbutton(root, text="Online motion/ROI metrics", variable=self.analysis_enabled).pack()
 
         self.root.protocol("WM_DELETE_WINDOW", self.on_close)
 
+    def publish_settings(self, **changes):
+        """Replace the settings snapshot with `changes` applied and a new version."""
+        with self.settings_lock:
+            self.settings = replace(self.settings, version=self.settings.version + 1, **changes)
+
+    def on_setting_changed(self, name, var):
+        """Tk trace callback (main thread): publish the new value of a control."""
+        try:
+            value = var.get()
+        except tk.TclError:
+            return  # entry being edited (e.g. empty fps field), keep the last valid value
+        if getattr(self.settings, name) != value:
+            if name == "rotation" and self.recording:
+                # frame shape must not change under the open writer (menu is disabled too)
+                var.set(self.settings.rotation)
+            elif name == "rotation":
+                # ROI is in rotated coordinates, it no longer matches the new orientation
+                self.publish_settings(rotation=value, roi=None)
+            else:
+                self.publish_settings(**{name: value})
+
     def check_save_path(self):
 
         base_path = self.save_path.get()
@@ -200,17 +266,22 @@ class FLIRApp:
                 drawing = False
                 roi_end = (x, y)
         cv2.setMouseCallback("FLIR Preview", mouse_callback)
-        rot_angle = self.rotation.get()
+        last_settings = self.settings
 
         while self.acquiring:
 
-            current_compression = self.compression.get()
-            if current_compression != self.last_compression:
-                print(f"Compression changed: {self.last_compression} → {current_compression}")
-                self.last_compression = current_compression
-                self.update_writer = True  # trigger next writer preparation
-
-            current_preview_enabled = self.preview_enabled.get()
+            settings = self.settings  # one snapshot per frame
+            if settings.version != last_settings.version:
+                if settings.compression != last_settings.compression:
+                    print(f"Compression changed: {last_settings.compression} → {settings.compression}")
+                    self.update_writer = True  # trigger next writer preparation
+                if settings.roi != last_settings.roi or settings.rotation != last_settings.rotation:
+                    self.update_writer = True  # frame shape changed
+                last_settings = settings
+            rot_angle = settings.rotation
+            roi_defined = settings.roi is not None
+
+            current_preview_enabled = settings.preview_enabled
             image = self.cam.GetNextImage()
             frame_timestamp = image.GetTimeStamp()  # uint64, in microseconds
             if image.IsIncomplete():
@@ -227,34 +298,35 @@ class FLIRApp:
             elif rot_angle == 270:
                 frame_rec = cv2.rotate(frame_rec, cv2.ROTATE_90_CLOCKWISE)
 
-            if self.roi_defined:
-                x, y, w, h = self.roi
+            if roi_defined:
+                x, y, w, h = settings.roi
                 frame_rec = frame_rec[y:y+h, x:x+w]
             h, w = frame_rec.shape
             with self.frame_lock:
                 self.frame_width = w
                 self.frame_height = h
-            if self.update_writer :
+            # only between recordings: in Trigger mode the prepared writer may be started
+            # by the next TTL edge, so a pending change waits until recording stops
+            if self.update_writer and not self.recording and self.current_thread_writer is None:
                 self.next_thread_writer = self.prepare_next_writer(self.trial_index)
-            self.update_writer = False
+                self.update_writer = False
 
             image.Release()
             if self.last_preview_enabled and not current_preview_enabled:
                 cv2.destroyWindow("FLIR Preview")
             if current_preview_enabled:
-                rot_angle = self.rotation.get()
                 frame_disp = np.copy(frame_rec)
                 frame_disp = np.ascontiguousarray(frame_disp)
                 frame_disp = frame_disp.astype(np.uint8)
                 # Draw ROI during selection
-                if roi_start and roi_end and (not self.recording or self.roi_defined):
+                if roi_start and roi_end and (not self.recording or roi_defined):
                     x1, y1 = roi_start
                     x2, y2 = roi_end
                     cv2.rectangle(frame_disp, (x1, y1), (x2, y2), (0, 255, 0), 2)
 
             
             # Recording logic
-            if self.mode.get() == "Trigger" and self.recording:
+            if settings.mode == "Trigger" and self.recording:
                 trigger_line_state = self.get_line_status(trigger_line_id)
                 if trigger_line_state and not last_trigger_line_state:
                     # TTL rising edge → start recording
@@ -275,15 +347,23 @@ class FLIRApp:
                 if self.start_rec_time_hardware is None:
                     self.start_rec_time_hardware = frame_timestamp
 
+                timestamp_sec = (frame_timestamp - self.start_rec_time_hardware) / 1e6
                 sync_line_state = self.get_line_status(sync_line_id)
                 if sync_line_state and not last_sync_line_state:
                     timestamp = time.time() - self.start_rec_time
-                    self.ttl_log.append(timestamp)
-                timestamp_sec = (frame_timestamp - self.start_rec_time_hardware) / 1e6
+                    # keep the frame the edge was seen on: links the host and camera clocks
+                    self.ttl_log.append((timestamp, len(self.frames_times_log), timestamp_sec))
                 self.frames_times_log.append(timestamp_sec)
                 frame_to_push = frame_rec.copy()
                 with self.queue_lock:
                     self.frame_queue.append(frame_to_push)
+                t_analysis = self.current_thread_analysis
+                if t_analysis is not None and t_analysis.is_alive():
+                    # same array as the writer gets (read-only on both sides), no extra copy
+                    with self.analysis_lock:
+                        if len(self.analysis_queue) == self.analysis_queue.maxlen:
+                            t_analysis.dropped += 1  # append pushes the oldest frame out
+                        self.analysis_queue.append((len(self.frames_times_log) - 1, timestamp_sec, frame_to_push))
     
 
                 if current_preview_enabled:
@@ -293,23 +373,20 @@ class FLIRApp:
                 cv2.imshow("FLIR Preview", frame_disp)
                 key = cv2.waitKey(1) & 0xFF
                 if key == ord('c') and not self.recording:
-                    if self.roi_defined:
+                    if roi_defined:
                         print("ROI already defined, ignoring 'c'")
                     elif roi_start and roi_end:
                         x1, y1 = roi_start
                         x2, y2 = roi_end
                         w = (abs(x2-x1)//16)*16
                         h = (abs(y2-y1)//16)*16
-                        self.roi = (min(x1, x2), min(y1, y2), w, h)
-                        self.roi_defined = True
-                        print(f"ROI defined: {self.roi}")
-                        self.update_writer = True
+                        roi = (min(x1, x2), min(y1, y2), w, h)
+                        self.publish_settings(roi=roi)  # writer is re-prepared on the next frame
+                        print(f"ROI defined: {roi}")
 
                 elif key == ord('f') and not self.recording:
-                    self.roi_defined = False
-                    self.roi = None
+                    self.publish_settings(roi=None)
                     print("Reset to full frame")
-                    self.update_writer = True
 
 
             last_sync_line_state = sync_line_state
@@ -333,13 +410,98 @@ class FLIRApp:
         self.current_thread_writer.active = True
         self.next_thread_writer = None
 
+        if self.settings.analysis_enabled:
+            self.current_thread_analysis = self.start_analysis()
+
+    def start_analysis(self):
+        """Start the online metrics thread for the trial being recorded."""
+        with self.analysis_lock:
+            self.analysis_queue.clear()
+        t = threading.Thread(target=self.analysis_thread, daemon=True)
+        t.stop_flag = False
+        t.dropped = 0
+        t.filename = os.path.join(
+            self.settings.save_path,
+            f"{self.date_now.strftime('%Y%m%d_%Hh%M')}_trial{self.trial_index}_frame_metrics.csv"
+        )
+        t.start()
+        return t
+
+    def analysis_thread(self):
+        """Stream per-frame motion energy and sub-region mean intensity to CSV.
+
+        Rows are keyed by frame_index / timestamp_seconds, i.e. the same rows as
+        the trial's _frame_timestamps.csv. Frames are block-averaged by
+        `analysis_downsample`; motion energy is the mean absolute difference with
+        the previous downsampled frame (NaN for the first frame of the trial, or
+        when the previous frame was dropped because the analysis fell behind).
+        """
+        t = threading.current_thread()
+        k = analysis_downsample
+        n_rows, n_cols = analysis_grid
+        prev = None
+        curr = None
+        prev_index = None
+
+        with open(t.filename, "w", newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(["frame_index", "timestamp_seconds", "motion_energy"]
+                            + [f"roi_{r}_{c}_mean" for r in range(n_rows) for c in range(n_cols)])
+            while True:
+                item = None
+                with self.analysis_lock:
+                    if t.stop_flag:
+                        # do not drain: the acquisition thread is waiting on us
+                        t.dropped += len(self.analysis_queue)
+                        self.analysis_queue.clear()
+                        break
+                    if self.analysis_queue:
+                        item = self.analysis_queue.popleft()
+                if item is None:
+                    time.sleep(0.005)
+                    continue
+
+                frame_index, timestamp_sec, frame = item
+                h, w = frame.shape
+                hd, wd = h // k, w // k
+                if curr is None or curr.shape != (hd, wd):
+                    # (re)allocate the rolling buffers, frame size only changes with the ROI
+                    curr = np.empty((hd, wd), dtype=np.float32)
+                    prev = np.empty((hd, wd), dtype=np.float32)
+                    prev_index = None
+                # block average k x k pixels
+                np.mean(frame[:hd * k, :wd * k].reshape(hd, k, wd, k), axis=(1, 3), out=curr)
+
+                if prev_index == frame_index - 1:
+                    motion_energy = float(np.abs(curr - prev).mean())
+                else:
+                    motion_energy = float('nan')
+
+                # mean of each grid cell, edges that do not fill a cell are dropped
+                gh, gw = hd // n_rows, wd // n_cols
+                roi_means = curr[:gh * n_rows, :gw * n_cols].reshape(n_rows, gh, n_cols, gw).mean(axis=(1, 3))
+
+                writer.writerow([frame_index, timestamp_sec, motion_energy] + roi_means.ravel().tolist())
+                prev, curr = curr, prev
+                prev_index = frame_index
+
+        print(f"[Analysis] Finished writing {t.filename} ({t.dropped} frames dropped)")
+
+    def stop_analysis(self):
+        t = self.current_thread_analysis
+        if t is not None:
+            t.stop_flag = True  # thread exits after the current frame, pending ones are dropped
+            t.join()
+            self.current_thread_analysis = None
+
 
     def prepare_next_writer(self, trial_index):
         """Create the next writer thread but leave it inactive."""
-        ext = "mkv" if self.compression.get() == "FFV1" else "avi"
+        settings = self.settings
+        ext = "mkv" if settings.compression == "FFV1" else "avi"
 
         filename = os.path.join(
-            self.save_path.get(),
+            settings.save_path,
             f"{datetime.datetime.now():%Y%m%d_%Hh%M}_trial{trial_index}.{ext}"  ### issue extension
         )
 
@@ -357,7 +519,7 @@ class FLIRApp:
         t.stop_flag = False
         t.filename = filename
         # t.codec = "ffv1" if self.compression.get() == "FFV1" else "rawvideo"  ## imageio style
-        t.codec = "FFV1" if self.compression.get() == "FFV1" else "Y800"   ###opencv
+        t.codec = "FFV1" if settings.compression == "FFV1" else "Y800"   ###opencv
         t.start()
         print(f"[Writer] Prewarmed writer for trial {trial_index}")
         return t
@@ -366,7 +528,7 @@ class FLIRApp:
         """Writer thread using OpenCV (pre-sized, no lazy init)."""
         t = threading.current_thread()
         fourcc = cv2.VideoWriter_fourcc(*t.codec)
-        fps = self.fps.get()
+        fps = self.settings.fps
         with self.frame_lock:
             width = self.frame_width
             height = self.frame_height
@@ -402,21 +564,22 @@ class FLIRApp:
             t.stop_flag = True
             t.join()
             self.current_thread_writer = None
+            self.stop_analysis()
             # Save TTL timestamps
             filename_ttl = os.path.join(
-                self.save_path.get(),
+                self.settings.save_path,
                 f"{self.date_now.strftime('%Y%m%d_%Hh%M')}_trial{self.trial_index}_sync_ttl.csv"
             )
             with open(filename_ttl, "w", newline='') as f:
                 writer = csv.writer(f)
-                writer.writerow(["timestamp_seconds"])
+                writer.writerow(["timestamp_seconds", "frame_index", "frame_timestamp_seconds"])
                 for t in self.ttl_log:
-                    writer.writerow([t])
+                    writer.writerow(list(t))
             self.ttl_log = []
 
             # Save frame timestamps
             filename_frames = os.path.join(
-                self.save_path.get(),
+                self.settings.save_path,
                 f"{self.date_now.strftime('%Y%m%d_%Hh%M')}_trial{self.trial_index}_frame_timestamps.csv"
             )
             with open(filename_frames, "w", newline='') as f:
@@ -453,11 +616,13 @@ class FLIRApp:
         if self.trial_index == 0:
             self.next_thread_writer = self.prepare_next_writer(self.trial_index)
         self.recording = True
+        self.rotation_menu.config(state="disabled")
         self.check_save_path()
         print("Recording started")
 
     def stop_recording(self):
         self.recording = False
+        self.rotation_menu.config(state="normal")
 
         if self.current_thread_writer and self.current_thread_writer.is_alive():
             self.stop_writer()
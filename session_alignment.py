@@ -0,0 +1,155 @@
+"""Session-level TTL-to-frame alignment for a folder of recorded trials.
+
+The sync line is polled once per recorded frame, and each TTL row of _sync_ttl.csv
+holds the host time (time.time() since the trial started), the index of the frame the
+edge was seen on and that frame's camera time (_frame_timestamps.csv clock). These
+pairs are real host/camera measurements, so per trial
+    ttl_host = offset + (1 + drift) * ttl_camera
+is fitted on them; map_host_times() uses the fit to put other host-clock events on
+frames. fit_rms / ttl_error are the fit residuals (host seconds).
+
+Files recorded before the frame columns existed hold only the host time: their
+TTLs get frame -1 and offset, drift and residuals NaN, since the two CSVs alone
+do not link the clocks.
+
+Trials are the _frame_timestamps.csv / _sync_ttl.csv pairs of the folder (same stamp
+and trial index); the video file is only attached as metadata ("" if missing, e.g.
+AVIs removed after offline compression).
+
+The result is saved as one columnar .npz (session_alignment.npz in the folder):
+    per trial : trial, stamp, video, n_frames, n_ttl, ttl_start, clock_offset, clock_drift, fit_rms
+    per TTL   : ttl_trial, ttl_host, ttl_camera, ttl_frame, ttl_error
+ttl_trial is the row in the per-trial columns (trial numbers restart when the app
+is relaunched); the TTLs of row k are ttl_start[k]:ttl_start[k] + n_ttl[k].
+
+Usage:
+    python session_alignment.py <save_path> [n_workers]
+"""
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from trial_reader import csv_pattern, find_trials, load_column_csv, load_ttl_csv, nearest_indices
+
+alignment_filename = "session_alignment.npz"
+
+
+def fit_clock(ttl_host, ttl_camera):
+    """Fit host time against camera time on the recorded TTL pairs of one trial.
+
+    Returns (offset, drift, residuals) with residuals = ttl_host - fitted host time.
+    """
+    if ttl_host.size >= 3 and np.ptp(ttl_camera) > 0:
+        slope, offset = np.polyfit(ttl_camera, ttl_host, 1)
+        drift = slope - 1.0
+    else:
+        # too few TTLs to see drift, only estimate the offset
+        offset = float(np.median(ttl_host - ttl_camera))
+        drift = 0.0
+    residuals = ttl_host - (offset + (1.0 + drift) * ttl_camera)
+    return float(offset), float(drift), residuals
+
+
+def map_host_times(host_times, offset, drift, frames_camera):
+    """Nearest frame index for host-clock times, using a trial's fitted clock."""
+    camera_times = (np.asarray(host_times, dtype=np.float64) - offset) / (1.0 + drift)
+    return nearest_indices(frames_camera, camera_times)
+
+
+def find_session_trials(save_path):
+    """List the trials of a folder from their CSV files, sorted by (stamp, trial).
+
+    Returns dicts with keys trial, stamp, frame_timestamps, sync_ttl (path or None)
+    and video (path or None).
+    """
+    trials = {}
+    for name in os.listdir(save_path):
+        m = csv_pattern.match(name)
+        if m and m.group(3) in ("frame_timestamps", "sync_ttl"):
+            key = (m.group(1), int(m.group(2)))
+            entry = trials.setdefault(key, {"trial": key[1], "stamp": key[0], "frame_timestamps": None,
+                                            "sync_ttl": None, "video": None})
+            entry[m.group(3)] = os.path.join(save_path, name)
+
+    video_of = {}
+    for t in find_trials(save_path):
+        for kind in ("frame_timestamps", "sync_ttl"):
+            if t[kind] is not None:
+                video_of[t[kind]] = t["video"]
+    for entry in trials.values():
+        entry["video"] = video_of.get(entry["frame_timestamps"]) or video_of.get(entry["sync_ttl"])
+    return [trials[key] for key in sorted(trials)]
+
+
+def align_trial(trial):
+    """Load the CSVs of one trial (entry from find_session_trials) and align its TTLs."""
+    n_frames = load_column_csv(trial["frame_timestamps"]).size
+    ttl_host, ttl_frame, ttl_camera = load_ttl_csv(trial["sync_ttl"])
+
+    if ttl_host.size == 0 or np.isnan(ttl_camera).any():
+        # no TTL, or an old file without the frame columns: nothing links the clocks
+        missing = np.full(ttl_host.size, np.nan)
+        return (n_frames, ttl_host, missing, np.full(ttl_host.size, -1, dtype=np.int64), missing,
+                np.nan, np.nan, np.nan)
+
+    offset, drift, residuals = fit_clock(ttl_host, ttl_camera)
+    rms = float(np.sqrt(np.mean(residuals ** 2)))
+    return n_frames, ttl_host, ttl_camera, ttl_frame, residuals, offset, drift, rms
+
+
+def align_session(save_path, n_workers=8, output=None):
+    """Align every trial in `save_path` and write the session index.
+
+    Returns the dict of columns that was saved.
+    """
+    trials = find_session_trials(save_path)
+    with ThreadPoolExecutor(max_workers=max(1, n_workers)) as pool:
+        results = list(pool.map(align_trial, trials))
+
+    n_frames = np.array([r[0] for r in results], dtype=np.int64)
+    n_ttl = np.array([r[1].size for r in results], dtype=np.int64)
+    ttl_start = np.cumsum(n_ttl) - n_ttl
+
+    def column(i, dtype):
+        parts = [r[i] for r in results]
+        return np.concatenate(parts).astype(dtype) if parts else np.empty(0, dtype=dtype)
+
+    index = {
+        "trial": np.array([t["trial"] for t in trials], dtype=np.int32),
+        "stamp": np.array([t["stamp"] for t in trials], dtype=str),
+        "video": np.array([os.path.basename(t["video"]) if t["video"] else "" for t in trials], dtype=str),
+        "n_frames": n_frames,
+        "n_ttl": n_ttl,
+        "ttl_start": ttl_start,
+        "clock_offset": np.array([r[5] for r in results], dtype=np.float64),
+        "clock_drift": np.array([r[6] for r in results], dtype=np.float64),
+        "fit_rms": np.array([r[7] for r in results], dtype=np.float64),
+        "ttl_trial": np.repeat(np.arange(len(trials), dtype=np.int32), n_ttl),
+        "ttl_host": column(1, np.float64),
+        "ttl_camera": column(2, np.float64),
+        "ttl_frame": column(3, np.int64),
+        "ttl_error": column(4, np.float32),
+    }
+
+    if output is None:
+        output = os.path.join(save_path, alignment_filename)
+    np.savez(output, **index)
+    print(f"[Alignment] {len(trials)} trials, {int(n_ttl.sum())} TTLs saved: {output}")
+    return index
+
+
+def load_alignment(path):
+    """Load a session index saved by align_session (folder or .npz path)."""
+    if os.path.isdir(path):
+        path = os.path.join(path, alignment_filename)
+    with np.load(path) as data:
+        return {key: data[key] for key in data.files}
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    align_session(sys.argv[1], n_workers=int(sys.argv[2]) if len(sys.argv) > 2 else 8)
@@ -0,0 +1,324 @@
+"""Random-access frame reader for trials recorded with launch_camera_singleROI.py.
+
+Every trial folder contains, per trial:
+    <stamp>_trial<i>.avi / .mkv                (RAW Y800 AVI or FFV1 MKV)
+    <stamp>_trial<i>_frame_timestamps.csv      (hardware clock, seconds from first frame)
+    <stamp>_trial<i>_sync_ttl.csv              (host clock, seconds from recording start, plus
+                                                the frame index / camera time the TTL was seen on)
+Offline-compressed folders (ffv1_compression_gui.py) hold the same files with .mkv videos.
+
+Only the offline-compressed MKVs are all-intra (-g 1). RAW AVIs are intra by nature,
+but live FFV1 MKVs come from OpenCV's FFmpeg writer with its default GOP (12 frames).
+A read therefore seeks back to the keyframe before the requested frame and decodes
+forward from there: keep any_frame=False in the seek, or live FFV1 frames come out wrong.
+The seek index (presentation timestamp of every packet) is built by demuxing only,
+without decoding, and cached in memory and next to the video (<video name>_seek_index.npy,
+e.g. ..._trial3.mkv_seek_index.npy).
+
+Example:
+    trials = find_trials("C:/Users/alan/Desktop/mouse01")
+    reader = TrialReader(trials[0]["video"], trials[0]["frame_timestamps"], n_threads=4)
+    batch = reader.read_range(100, 200)          # (100, height, width) uint8
+    batch = reader.read_at_times([1.5, 2.0])     # frames nearest to those timestamps
+"""
+import os
+import re
+import threading
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import av
+
+video_pattern = re.compile(r"^(\d{8}_\d{2}h\d{2})_trial(\d+)\.(avi|mkv)$", re.IGNORECASE)
+csv_pattern = re.compile(r"^(\d{8}_\d{2}h\d{2})_trial(\d+)_(frame_timestamps|sync_ttl|frame_metrics)\.csv$")
+
+# seek indexes already built, keyed by (path, size, mtime) so a re-written file is re-indexed
+_index_cache = {}
+index_suffix = "_seek_index.npy"  # appended to the full video file name
+_index_cache_lock = threading.Lock()
+
+
+def load_column_csv(path, column=0):
+    """Load one column of a CSV written by the acquisition script (one header row)."""
+    if path is None or not os.path.exists(path):
+        return np.empty(0, dtype=np.float64)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")  # header-only files (no TTL during the trial)
+        return np.loadtxt(path, delimiter=",", skiprows=1, ndmin=1, usecols=column, dtype=np.float64)
+
+
+def load_ttl_csv(path):
+    """Load a _sync_ttl.csv as (host time, frame index, camera time) arrays.
+
+    Files recorded before the frame columns were added only hold the host time;
+    their frame index is -1 and camera time NaN.
+    """
+    host = load_column_csv(path)
+    try:
+        frame = load_column_csv(path, column=1).astype(np.int64)
+        camera = load_column_csv(path, column=2)
+    except (ValueError, IndexError):
+        frame = np.full(host.size, -1, dtype=np.int64)
+        camera = np.full(host.size, np.nan)
+    return host, frame, camera
+
+
+def nearest_indices(sorted_values, queries):
+    """Index of the nearest element of `sorted_values` for each query (vectorized)."""
+    sorted_values = np.asarray(sorted_values)
+    queries = np.asarray(queries, dtype=np.float64)
+    if sorted_values.size == 0:
+        raise ValueError("Cannot match against an empty array")
+    if sorted_values.size == 1:
+        return np.zeros(queries.shape, dtype=np.int64)
+    idx = np.clip(np.searchsorted(sorted_values, queries), 1, sorted_values.size - 1)
+    left = sorted_values[idx - 1]
+    right = sorted_values[idx]
+    idx -= (queries - left) <= (right - queries)
+    return idx.astype(np.int64)
+
+
+def find_trials(folder):
+    """Pair each trial video in `folder` with its CSV files.
+
+    The video name is stamped when its writer is prepared, the CSVs when the trial
+    actually starts, so the stamps may differ. Each CSV goes to the latest video of
+    the same trial index whose stamp is not later than its own. The writer prepared
+    for the next trial at the end of a session never gets CSVs (fields are None),
+    even when the folder is reused and trial numbers restart.
+
+    Returns a list of dicts (sorted by stamp, trial) with keys
+    trial, stamp, video, frame_timestamps, sync_ttl, frame_metrics (paths or None).
+    """
+    trials = []
+    by_trial = {}
+    csvs = []
+    for name in sorted(os.listdir(folder)):
+        m = video_pattern.match(name)
+        if m:
+            entry = {"trial": int(m.group(2)), "stamp": m.group(1), "video": os.path.join(folder, name),
+                     "frame_timestamps": None, "sync_ttl": None, "frame_metrics": None}
+            trials.append(entry)
+            by_trial.setdefault(entry["trial"], []).append(entry)
+            continue
+        m = csv_pattern.match(name)
+        if m:
+            csvs.append((m.group(1), int(m.group(2)), m.group(3), os.path.join(folder, name)))
+    trials.sort(key=lambda e: (e["stamp"], e["trial"]))
+    for entries in by_trial.values():
+        entries.sort(key=lambda e: e["stamp"])
+
+    # earliest CSVs first, so a video keeps the one closest to its own stamp
+    for csv_stamp, trial, kind, path in sorted(csvs):
+        owner = None
+        for entry in by_trial.get(trial, []):
+            if entry["stamp"] > csv_stamp:
+                break
+            owner = entry
+        if owner is not None and owner[kind] is None:
+            owner[kind] = path
+    return trials
+
+
+def build_seek_index(video_path):
+    """Return the packet pts of every frame, in presentation order (cached).
+
+    The index is saved next to the video as [size, mtime_ns, pts...] so later runs
+    skip the demux; it is rebuilt when the video size or mtime no longer match.
+    """
+    stat = os.stat(video_path)
+    key = (os.path.abspath(video_path), stat.st_size, stat.st_mtime_ns)
+    with _index_cache_lock:
+        if key in _index_cache:
+            return _index_cache[key]
+
+    index_path = video_path + index_suffix  # full name: trialN.avi and trialN.mkv may sit side by side
+    try:
+        saved = np.load(index_path)
+        if saved.size >= 2 and saved[0] == stat.st_size and saved[1] == stat.st_mtime_ns:
+            with _index_cache_lock:
+                _index_cache[key] = saved[2:]
+            return saved[2:]
+    except (OSError, ValueError):
+        pass  # no index yet, or unreadable: rebuild it
+
+    pts = []
+    with av.open(video_path) as container:
+        stream = container.streams.video[0]
+        for packet in container.demux(stream):
+            if packet.size == 0:  # flush packet
+                continue
+            pts.append(packet.pts if packet.pts is not None else packet.dts)
+    if any(p is None for p in pts):
+        raise ValueError(f"{video_path}: packets without timestamps, cannot build a seek index")
+    index = np.sort(np.asarray(pts, dtype=np.int64))
+
+    try:
+        np.save(index_path, np.concatenate(([stat.st_size, stat.st_mtime_ns], index)).astype(np.int64))
+    except OSError as e:
+        print(f"[Reader] could not save seek index {index_path}: {e}")
+    with _index_cache_lock:
+        _index_cache[key] = index
+    return index
+
+
+class TrialReader:
+    """Read arbitrary frames of one trial video as preallocated uint8 batches."""
+
+    def __init__(self, video_path, timestamps_path=None, ttl_path=None, n_threads=1):
+        self.video_path = video_path
+        self.n_threads = max(1, int(n_threads))
+        self.pts = build_seek_index(video_path)
+
+        with av.open(video_path) as container:
+            stream = container.streams.video[0]
+            self.width = stream.codec_context.width
+            self.height = stream.codec_context.height
+
+        self.timestamps = load_column_csv(timestamps_path)
+        self.ttl, self.ttl_frame, self.ttl_camera = load_ttl_csv(ttl_path)
+        self.n_frames = len(self.pts)
+        if timestamps_path is not None and len(self.timestamps) != self.n_frames:
+            # writer queue still held frames when the trial stopped, or frames were dropped
+            print(f"[Reader] {os.path.basename(video_path)}: {self.n_frames} frames but "
+                  f"{len(self.timestamps)} timestamps, using the first {min(self.n_frames, len(self.timestamps))}")
+            self.n_frames = min(self.n_frames, len(self.timestamps))
+            self.timestamps = self.timestamps[:self.n_frames]
+
+        self._local = threading.local()  # one open container per decoding thread
+        self._pool = None
+
+    @classmethod
+    def from_trial(cls, trial, n_threads=1):
+        """Build a reader from an entry returned by find_trials()."""
+        return cls(trial["video"], trial["frame_timestamps"], trial["sync_ttl"], n_threads=n_threads)
+
+    def __len__(self):
+        return self.n_frames
+
+    def empty_batch(self, n):
+        return np.empty((n, self.height, self.width), dtype=np.uint8)
+
+    def read_range(self, start, stop, out=None):
+        """Frames [start, stop) as an array of shape (stop - start, height, width)."""
+        start = max(0, int(start))
+        stop = min(self.n_frames, int(stop))
+        return self.read_frames(np.arange(start, max(start, stop)), out=out)
+
+    def read_frames(self, indices, out=None):
+        """Frames at `indices` (any order, repeats allowed), in the order requested."""
+        indices = np.asarray(indices, dtype=np.int64).ravel()
+        if indices.size and (indices.min() < 0 or indices.max() >= self.n_frames):
+            raise IndexError(f"Frame index out of range [0, {self.n_frames})")
+        if out is None:
+            out = self.empty_batch(indices.size)
+        elif out.shape != (indices.size, self.height, self.width):
+            raise ValueError(f"out has shape {out.shape}, expected {(indices.size, self.height, self.width)}")
+        if indices.size == 0:
+            return out
+
+        # decode each unique frame once, as contiguous runs (one seek per run)
+        unique, inverse = np.unique(indices, return_inverse=True)
+        decoded = out if unique.size == indices.size else self.empty_batch(unique.size)
+        runs = self._split_runs(unique)
+        if self.n_threads == 1 or len(runs) == 1:
+            for first, start, stop in runs:
+                self._decode_run(start, stop, decoded[first:first + stop - start])
+        else:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.n_threads)
+            jobs = [self._pool.submit(self._decode_run, start, stop, decoded[first:first + stop - start])
+                    for first, start, stop in runs]
+            for job in jobs:
+                job.result()
+
+        inverse = inverse.ravel()
+        if decoded is not out:
+            np.take(decoded, inverse, axis=0, out=out)
+        elif np.any(np.diff(indices) < 0):
+            out[:] = out[inverse]  # runs were decoded in sorted order, restore the requested one
+        return out
+
+    def frame_indices_at(self, times):
+        """Nearest frame index for each time (seconds, frame_timestamps clock)."""
+        if self.timestamps.size == 0:
+            raise ValueError(f"{self.video_path}: no frame timestamps loaded")
+        return nearest_indices(self.timestamps, times)
+
+    def read_at_times(self, times, out=None):
+        return self.read_frames(self.frame_indices_at(times), out=out)
+
+    def read_at_ttl(self, offset=0.0, out=None):
+        """Frames nearest to each sync TTL (+ `offset` seconds, camera clock).
+
+        Uses the camera time of the frame each TTL was seen on. Older files without
+        it fall back to the host-clock TTL time, which is only approximate.
+        """
+        times = np.where(np.isnan(self.ttl_camera), self.ttl, self.ttl_camera)
+        return self.read_at_times(times + offset, out=out)
+
+    def _split_runs(self, sorted_indices):
+        """Split sorted unique indices into (position in batch, start, stop) runs.
+
+        Long runs are cut so that every decoding thread gets work.
+        """
+        breaks = np.flatnonzero(np.diff(sorted_indices) != 1) + 1
+        bounds = np.concatenate(([0], breaks, [sorted_indices.size]))
+        max_len = max(1, -(-sorted_indices.size // self.n_threads))
+        runs = []
+        for a, b in zip(bounds[:-1], bounds[1:]):
+            for first in range(a, b, max_len):
+                last = min(b, first + max_len)
+                runs.append((first, int(sorted_indices[first]), int(sorted_indices[first]) + last - first))
+        return runs
+
+    def _container(self):
+        container = getattr(self._local, "container", None)
+        if container is None:
+            container = av.open(self.video_path)
+            self._local.container = container
+        return container
+
+    def _decode_run(self, start, stop, out):
+        container = self._container()
+        stream = container.streams.video[0]
+        # the demuxer may land after the requested frame: seek further back until it does not
+        for seek_to in (start, start - 16, start - 256, 0):
+            if seek_to < 0:
+                continue
+            container.seek(int(self.pts[seek_to]), stream=stream, backward=True, any_frame=False)
+            i = None
+            landed_late = False
+            for frame in container.decode(stream):
+                if frame.pts is None:
+                    raise ValueError(f"{self.video_path}: decoded frame without pts")
+                if i is None:
+                    i = int(np.searchsorted(self.pts, frame.pts))
+                    if i > start:
+                        landed_late = True
+                        break  # landed too late, out[:i - start] would never be written
+                if i >= start:
+                    out[i - start] = frame.to_ndarray(format="gray")
+                i += 1
+                if i >= stop:
+                    return
+            if i is not None and not landed_late:
+                break  # decoding started in time but the file ended early, seeking back won't help
+        raise IOError(f"{self.video_path}: could not decode frames {start}..{stop - 1}")
+
+    def close(self):
+        """Close the container of the calling thread and stop the decoding threads."""
+        container = getattr(self._local, "container", None)
+        if container is not None:
+            container.close()
+            self._local.container = None
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)  # their containers are released with the threads
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()